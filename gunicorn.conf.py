@@ -0,0 +1,11 @@
+import multiprocessing
+import os
+
+# Run as `gunicorn web.main:app` from this directory.
+bind = os.getenv('BIND', '127.0.0.1:8000')
+# Each worker opens up to PG_POOL_MAX database connections, so keep
+# WORKERS * PG_POOL_MAX below the max_connections setting of PostgreSQL.
+workers = int(os.getenv('WORKERS', multiprocessing.cpu_count()))
+worker_class = 'proxy_worker.ProxyUvicornWorker'
+# Let the kernel balance incoming connections between workers.
+reuse_port = True
@@ -3,8 +3,8 @@ from uvicorn.workers import UvicornWorker
 
 class ProxyUvicornWorker(UvicornWorker):
     CONFIG_KWARGS = {
-        "loop": "auto",  # Use 'auto' to automatically choose the best loop, 'uvloop' can be specified for performance.
-        "http": "auto",  # Use 'auto' to automatically choose the best HTTP protocol support, 'httptools' can be specified.
+        "loop": "uvloop",  # Pinned instead of 'auto' so we never fall back to the asyncio loop.
+        "http": "httptools",  # Pinned instead of 'auto' so we never fall back to h11.
         "lifespan": "on",  # 'on' to enable lifespan support.
         "proxy_headers": True,  # Corresponding to `--proxy-headers`
         "forwarded_allow_ips": "*",  # Corresponding to `--forwarded-allow-ips=*`
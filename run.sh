@@ -13,4 +13,4 @@ if [ ! -d "$VENV" ]; then
     "$VENV"/bin/pip install -r "$HERE/web/requirements.txt"
 fi
 
-"$VENV/bin/uvicorn" --host 0.0.0.0 --port 8000 web.main:app
+"$VENV/bin/uvicorn" --host 0.0.0.0 --port 8000 --loop uvloop --http httptools web.main:app
@@ -0,0 +1,32 @@
+from web.main import parse_user_details
+
+
+def details(attrs: str) -> bytes:
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<osm version="0.6" generator="OpenStreetMap server">\n'
+        f' <user {attrs} account_created="2010-01-01T00:00:00Z">\n'
+        '  <description></description>\n'
+        ' </user>\n'
+        '</osm>\n'
+    ).encode()
+
+
+def test_plain_name():
+    assert parse_user_details(details('id="1234" display_name="Zverik"')) == (
+        'Zverik', '1234')
+
+
+def test_attribute_order():
+    assert parse_user_details(details('display_name="Zverik" id="1234"')) == (
+        'Zverik', '1234')
+
+
+def test_named_entities():
+    content = details('id="1" display_name="Tom &amp; Jerry &quot;TJ&quot;"')
+    assert parse_user_details(content) == ('Tom & Jerry "TJ"', '1')
+
+
+def test_numeric_references():
+    content = details('id="1" display_name="O&#39;Brien &#x41;"')
+    assert parse_user_details(content) == ("O'Brien A", '1')
@@ -12,6 +12,12 @@ PG_USER = os.getenv('PGUSER', 'postgres')
 PG_PORT = os.getenv('PGPORT', '5432')
 PG_DATABASE = os.getenv('PGDATABASE', '')
 
+# Connection pool size per worker: keep workers * max under max_connections.
+PG_POOL_MIN = int(os.getenv('PG_POOL_MIN', '2'))
+PG_POOL_MAX = int(os.getenv('PG_POOL_MAX', '8'))
+PG_POOL_MAX_IDLE = float(os.getenv('PG_POOL_MAX_IDLE', '300'))  # in seconds
+PG_POOL_TIMEOUT = float(os.getenv('PG_POOL_TIMEOUT', '30'))  # wait for a connection
+
 # Geoscribble-specific numbers
 MAX_POINTS = int(os.getenv('MAX_POINTS', '100'))
 MAX_LENGTH = int(os.getenv('MAX_LENGTH', '5000'))  # in meters
@@ -21,6 +27,7 @@ DEFAULT_AGE = int(os.getenv('DEFAULT_AGE', '91'))  # three months
 MAX_COORD_SPAN = float(os.getenv('MAX_COORD_SPAN', '0.3'))
 MAX_IMAGE_WIDTH = int(os.getenv('MAX_IMAGE_WIDTH', '3000'))
 MAX_IMAGE_HEIGHT = int(os.getenv('MAX_IMAGE_HEIGHT', '2000'))
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '16'))  # in MB per worker
 
 # Fonts for labels
 FONT = os.getenv('FONT', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
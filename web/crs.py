@@ -1,10 +1,13 @@
-from math import radians, degrees, cos, tan, log, pi, asin, tanh
+import numpy as np
+from math import radians, degrees, tan, log, pi, atan, exp
 
 
 __all__ = ['BaseCRS', 'CRS_LIST', 'BBox']
 
 
 EARTH_RADIUS = 6378137
+# Latitude where Web Mercator becomes a square.
+MAX_LAT = 85.0511287798
 
 
 class BaseCRS:
@@ -12,6 +15,11 @@ class BaseCRS:
         """Always returns (x, y)."""
         return lon, lat
 
+    def coords_to_pixel_batch(self, lons: np.ndarray,
+                              lats: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Same as coords_to_pixel, but for arrays of coordinates."""
+        return lons, lats
+
     def pixel_to_coords(self, x: float, y: float) -> tuple[float, float]:
         """Returns either (lon, lat) or (lat, lon) depending on CRS."""
         return x, y
@@ -27,19 +35,21 @@ class CRS_4326(BaseCRS):
 
 class CRS_3857(BaseCRS):
     def coords_to_pixel(self, lon: float, lat: float) -> tuple[float, float]:
-        rlat = radians(lat)
+        rlat = radians(max(-MAX_LAT, min(MAX_LAT, lat)))
         x = radians(lon)
-        if lat > 85:
-            y = pi * 2
-        elif lat < -85:
-            y = -pi * 2
-        else:
-            y = log(tan(rlat) + (1/cos(rlat)))
+        y = log(tan(pi / 4 + rlat / 2))
+        return x * EARTH_RADIUS, y * EARTH_RADIUS
+
+    def coords_to_pixel_batch(self, lons: np.ndarray,
+                              lats: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        rlat = np.radians(np.clip(lats, -MAX_LAT, MAX_LAT))
+        x = np.radians(lons)
+        y = np.log(np.tan(pi / 4 + rlat / 2))
         return x * EARTH_RADIUS, y * EARTH_RADIUS
 
     def pixel_to_coords(self, x: float, y: float) -> tuple[float, float]:
         fx = x / EARTH_RADIUS
-        fy = asin(tanh(y / EARTH_RADIUS))
+        fy = 2 * atan(exp(y / EARTH_RADIUS)) - pi / 2
         return degrees(fx), degrees(fy)
 
     @property
@@ -68,6 +78,15 @@ class BBox:
             y = 1 - y
         return x, y
 
+    def to_pixel_batch(self, lonlat: np.ndarray) -> np.ndarray:
+        """Projects an (N, 2) array of (lon, lat) into an (N, 2) array of (x, y)."""
+        px, py = self.crs.coords_to_pixel_batch(lonlat[:, 0], lonlat[:, 1])
+        x = (px - self.x) / self.w
+        y = (py - self.y) / self.h
+        if self.crs.flip:
+            y = 1 - y
+        return np.column_stack((x, y))
+
     def to_4326(self) -> list[float]:
         return [
             *self.crs.pixel_to_coords(self.x, self.y),
@@ -1,13 +1,17 @@
 import asyncio
 import aiohttp
+import functools
 import os
-import json
 import logging
+from bisect import bisect_left
+from math import floor, ceil
+import orjson
+from cachetools import TTLCache
 from datetime import datetime, timedelta
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, aclosing
 from psycopg_pool import AsyncConnectionPool
-from psycopg.rows import dict_row
-from typing import Union, Optional
+from psycopg.rows import dict_row, tuple_row, AsyncRowFactory
+from typing import AsyncGenerator, Union, Optional
 from . import config
 from .models import Scribble, Label, NewLabel, NewScribble, Deletion, Box, Task
 
@@ -21,19 +25,24 @@ pool = AsyncConnectionPool(
         'row_factory': dict_row,
     },
     open=False,
+    min_size=config.PG_POOL_MIN,
+    max_size=config.PG_POOL_MAX,
+    # Connections are checked when taken from the pool, not periodically.
+    check=AsyncConnectionPool.check_connection,
+    max_idle=config.PG_POOL_MAX_IDLE,
+    timeout=config.PG_POOL_TIMEOUT,
+    reconnect_timeout=30,
 )
 
 
-async def check_connections():
-    while True:
-        await asyncio.sleep(600)
-        await pool.check()
-
-
 @asynccontextmanager
-async def get_cursor(commit: bool = False):
+async def get_cursor(commit: bool = False, row_factory: Optional[AsyncRowFactory] = None,
+                     binary: bool = False):
     async with pool.connection() as conn:
-        cursor = conn.cursor()
+        if row_factory:
+            cursor = conn.cursor(row_factory=row_factory, binary=binary)
+        else:
+            cursor = conn.cursor(binary=binary)
         try:
             yield cursor
             if commit:
@@ -42,39 +51,233 @@ async def get_cursor(commit: bool = False):
             await cursor.close()
 
 
+@functools.cache
+def read_sql(name: str) -> str:
+    filename = os.path.join(os.path.dirname(__file__), name)
+    with open(filename, 'r') as f:
+        return f.read()
+
+
 async def create_table():
     async with get_cursor(True) as cur:
+        # Every worker runs this on startup, so let only one migrate at a time.
+        await cur.execute("select pg_advisory_xact_lock(hashtext('geoscribble_migrate'))")
         await cur.execute(
             "select 1 from pg_tables where schemaname='public' and tablename='tasks'")
         if not await cur.fetchone():
             # Table is missing, run the script
-            filename = os.path.join(os.path.dirname(__file__), 'v1_init_tables.sql')
-            with open(filename, 'r') as f:
-                sql = f.read()
-            await cur.execute(sql)
+            await cur.execute(read_sql('v1_init_tables.sql'))
+
+        await cur.execute(
+            "select 1 from information_schema.columns "
+            "where table_name='scribbles' and column_name='geohash10'")
+        if not await cur.fetchone():
+            await cur.execute(read_sql('v2_geohash.sql'))
+
+        await cur.execute(
+            "select 1 from pg_indexes "
+            "where tablename='scribbles' and indexname='scribbles_idx_geom_live'")
+        if not await cur.fetchone():
+            await cur.execute(read_sql('v3_live_indexes.sql'))
 
 
 async def init_database():
     await pool.open()
-    asyncio.create_task(check_connections())
     await create_table()
 
 
-def bbox_too_big(box: list[float]) -> bool:
-    if (abs(box[2] - box[0]) > config.MAX_COORD_SPAN or
-            abs(box[3] - box[1]) > config.MAX_COORD_SPAN):
-        return True
-    return False
+DEFAULT_AGE = timedelta(days=config.DEFAULT_AGE)
+
+
+def bbox_span(box: list[float]) -> tuple[float, float]:
+    return abs(box[2] - box[0]), abs(box[3] - box[1])
+
+
+def bbox_too_big(dx: float, dy: float) -> bool:
+    max_span = config.MAX_COORD_SPAN
+    return dx > max_span or dy > max_span
+
+
+# Upper bounds of area in square degrees, and geohash digits for each range.
+GEOHASH_AREAS = (40, 1000)
+GEOHASH_DIGITS = (5, 4, 3)
+
+
+def geohash_digits(dx: float, dy: float) -> int:
+    return GEOHASH_DIGITS[bisect_left(GEOHASH_AREAS, dx * dy)]
+
+
+# Formatted SQL for query(), keyed by (username, user_id, editor, overview).
+_QUERY_SQL: dict[tuple[bool, bool, bool, bool], str] = {}
+
+
+def query_sql(username: bool, user_id: bool, editor: bool, overview: bool) -> str:
+    key = (username, user_id, editor, overview)
+    sql = _QUERY_SQL.get(key)
+    if sql is not None:
+        return sql
 
+    add_queries = []
+    if username:
+        add_queries.append('and username = %s')
+    if user_id:
+        add_queries.append('and user_id = %s')
+    if editor:
+        add_queries.append('and editor = %s')
+
+    if not overview:
+        # The envelope is built once, so PostGIS can reuse its prepared geometry.
+        sql = """with env as materialized (
+            select ST_MakeEnvelope(%s, %s, %s, %s, 4326) g)
+        select s.scribble_id, s.created, s.username, s.user_id, s.editor,
+        s.style, s.color, s.dashed, s.thin, s.label,
+        case when ST_GeometryType(s.geom) = 'ST_Point'
+            then array[ST_X(s.geom), ST_Y(s.geom)] end pt,
+        case when ST_GeometryType(s.geom) = 'ST_LineString'
+            then (select array_agg(array[ST_X(p.geom), ST_Y(p.geom)] order by p.path)
+                  from ST_DumpPoints(s.geom) p) end pts
+        from scribbles s, env
+        where s.geom && env.g and ST_Intersects(s.geom, env.g)
+        and created >= now() - %s and deleted is null
+        {q}""".format(q=' '.join(add_queries))
+    else:
+        sql = """with t as (
+        select substr(geohash10, 1, %s) hash, min(now()-created) age
+        from scribbles
+        where geom && ST_MakeEnvelope(%s, %s, %s, %s, 4326)
+        and created >= now() - %s and deleted is null
+        {q} group by 1)
+        select ST_XMin(g) xmin, ST_YMin(g) ymin, ST_XMax(g) xmax, ST_YMax(g) ymax, age
+        from (select ST_GeomFromGeoHash(hash) g, extract(day from age)::integer age from t) sub
+        """.format(q=' '.join(add_queries))
+    _QUERY_SQL[key] = sql
+    return sql
+
+
+def geohash_bbox(box: list[float], digits: int) -> list[float]:
+    """Expands the box to the grid of geohash cells with the given number of digits."""
+    bits = digits * 5
+    cell_w = 360 / (1 << ((bits + 1) // 2))
+    cell_h = 180 / (1 << (bits // 2))
+    return [
+        floor(box[0] / cell_w) * cell_w,
+        floor(box[1] / cell_h) * cell_h,
+        ceil(box[2] / cell_w) * cell_w,
+        ceil(box[3] / cell_h) * cell_h,
+    ]
+
+
+# Overview results are the same for everybody looking at a big area,
+# so they are kept for a minute, keyed by the rounded bbox and filters.
+_overview_cache: TTLCache = TTLCache(maxsize=1024, ttl=60)
+
+
+def clear_overview_cache() -> None:
+    """Drops cached overview boxes after scribbles were added or deleted."""
+    _overview_cache.clear()
+
+
+async def query_overview(bbox: list[float], digits: int, age: timedelta,
+                         username: Optional[str] = None,
+                         user_id: Optional[int] = None,
+                         editor: Optional[str] = None) -> list[tuple]:
+    """Returns (xmin, ymin, xmax, ymax, minage) rows for overview boxes."""
+    bbox = geohash_bbox(bbox, digits)
+    key = (*bbox, digits, age, username, user_id, editor)
+    cached = _overview_cache.get(key)
+    if cached is not None:
+        return cached
+
+    params = [digits, *bbox, age]
+    if username:
+        params.append(username)
+    if user_id:
+        params.append(user_id)
+    if editor:
+        params.append(editor)
+    sql = query_sql(bool(username), bool(user_id), bool(editor), True)
+
+    async with get_cursor(row_factory=tuple_row, binary=True) as cur:
+        await cur.execute(sql, params, prepare=True)
+        result = await cur.fetchall()
+    _overview_cache[key] = result
+    return result
 
-def geohash_digits(box: list[float]) -> int:
-    # area in square degrees.
-    area = abs(box[2] - box[0]) * abs(box[3] - box[1])
-    if area > 1000:
-        return 3
-    if area > 40:
-        return 4
-    return 5
+
+async def query_raw(bbox: list[float], username: Optional[str] = None,
+                    user_id: Optional[int] = None,
+                    editor: Optional[str] = None,
+                    maxage: Optional[int] = None
+                    ) -> list[tuple[str, tuple]]:
+    """Returns ('scribble' | 'label' | 'box', row) pairs without building models.
+    Scribble and label rows are (scribble_id, created, username, user_id, editor,
+    style, color, dashed, thin, label, pt, pts), and box rows are
+    (xmin, ymin, xmax, ymax, minage)."""
+    age = timedelta(days=maxage) if maxage else DEFAULT_AGE
+    dx, dy = bbox_span(bbox)
+    if bbox_too_big(dx, dy):
+        boxes = await query_overview(
+            bbox, geohash_digits(dx, dy), age, username, user_id, editor)
+        return [('box', row) for row in boxes]
+
+    params = [*bbox, age]
+    if username:
+        params.append(username)
+    if user_id:
+        params.append(user_id)
+    if editor:
+        params.append(editor)
+    sql = query_sql(bool(username), bool(user_id), bool(editor), False)
+
+    # Rows are plain binary tuples: these loops are hot, and dicts and parsing are costly.
+    async with get_cursor(row_factory=tuple_row, binary=True) as cur:
+        # Prepared server-side, so Postgres reuses the plan for each connection.
+        await cur.execute(sql, params, prepare=True)
+        # Fetch everything, so the connection goes back to the pool before
+        # anything is sent to a possibly slow client.
+        rows = await cur.fetchall()
+    return [(('label' if row[10] is not None else 'scribble'), row) for row in rows]
+
+
+async def iter_query(bbox: list[float], username: Optional[str] = None,
+                     user_id: Optional[int] = None,
+                     editor: Optional[str] = None,
+                     maxage: Optional[int] = None
+                     ) -> AsyncGenerator[Union[Scribble, Label, Box], None]:
+    """Yields scribbles one by one, building models as they are needed.
+    Rows come from the database and were validated on upload, so models
+    are constructed without validation: limits might have changed since."""
+    for kind, row in await query_raw(bbox, username, user_id, editor, maxage):
+        if kind == 'box':
+            yield Box.model_construct(minage=row[4], box=[row[0], row[1], row[2], row[3]])
+            continue
+
+        (scribble_id, created, username, user_id, editor,
+         style, color, dashed, thin, label, pt, pts) = row
+        if kind == 'label':
+            yield Label.model_construct(
+                id=scribble_id,
+                created=created,
+                username=username,
+                user_id=user_id,
+                editor=editor or '',
+                location=(pt[0], pt[1]),
+                color=color,
+                text=label,
+            )
+        else:
+            yield Scribble.model_construct(
+                id=scribble_id,
+                created=created,
+                username=username,
+                user_id=user_id,
+                editor=editor or '',
+                style=style,
+                color=color,
+                dashed=dashed,
+                thin=thin,
+                points=list(map(tuple, pts)),
+            )
 
 
 async def query(bbox: list[float], username: Optional[str] = None,
@@ -82,195 +285,229 @@ async def query(bbox: list[float], username: Optional[str] = None,
                 editor: Optional[str] = None,
                 maxage: Optional[int] = None
                 ) -> list[Union[Scribble, Label, Box]]:
-    age = maxage or config.DEFAULT_AGE
-    result: list[Union[Scribble, Label]] = []
-    async with get_cursor() as cur:
-        params = [*bbox, timedelta(days=age)]
-        add_queries = []
-
-        if username:
-            add_queries.append('and username = %s')
-            params.append(username)
-        if user_id:
-            add_queries.append('and user_id = %s')
-            params.append(user_id)
-        if editor:
-            add_queries.append('and editor = %s')
-            params.append(editor)
-
-        overview = bbox_too_big(bbox)
-        if not overview:
-            sql = """select *, ST_AsGeoJSON(geom) json from scribbles
-            where ST_Intersects(geom, ST_MakeEnvelope(%s, %s, %s, %s, 4326))
-            and created >= now() - %s and deleted is null
-            {q}""".format(q=' '.join(add_queries))
-        else:
-            params.insert(0, geohash_digits(bbox))
-            sql = """with t as (
-            select ST_GeoHash(geom, %s) hash, min(now()-created) age
-            from scribbles
-            where geom && ST_MakeEnvelope(%s, %s, %s, %s, 4326)
-            and created >= now() - %s and deleted is null
-            {q} group by 1)
-            select ST_AsGeoJSON(ST_GeomFromGeoHash(hash)) json,
-            extract(day from age) age from t
-            """.format(q=' '.join(add_queries))
-
-        await cur.execute(sql, params)
-
-        async for row in cur:
-            geom = json.loads(row['json'])
-            if overview:
-                c = geom['coordinates'][0]
-                result.append(Box(
-                    minage=row['age'],
-                    box=[c[0][0], c[0][1], c[2][0], c[2][1]],
-                ))
-            elif geom['type'] == 'Point':
-                result.append(Label(
-                    id=row['scribble_id'],
-                    created=row['created'],
-                    username=row['username'],
-                    user_id=row['user_id'],
-                    editor=row['editor'] or '',
-                    location=(geom['coordinates'][0],
-                              geom['coordinates'][1]),
-                    color=row['color'],
-                    text=row['label'],
-                ))
-            else:
-                result.append(Scribble(
-                    id=row['scribble_id'],
-                    created=row['created'],
-                    username=row['username'],
-                    user_id=row['user_id'],
-                    editor=row['editor'] or '',
-                    style=row['style'],
-                    color=row['color'],
-                    dashed=row['dashed'],
-                    thin=row['thin'],
-                    points=geom['coordinates'],
-                ))
-    return result
+    async with aclosing(iter_query(bbox, username, user_id, editor, maxage)) as scribbles:
+        return [s async for s in scribbles]
+
+
+INSERT_SCRIBBLE_SQL = """insert into scribbles
+    (user_id, username, editor, style, color, thin, dashed, geom)
+    values (%s, %s, %s, %s, %s, %s, %s, ST_SetSRID(ST_GeomFromGeoJSON(%s), 4326))
+    returning scribble_id"""
+
+INSERT_LABEL_SQL = """insert into scribbles
+    (user_id, username, editor, color, label, geom)
+    values (%s, %s, %s, %s, %s, ST_Point(%s, %s, 4326))
+    returning scribble_id"""
+
+DELETE_SCRIBBLE_SQL = """update scribbles set deleted = now(), deleted_by_id = %s
+    where scribble_id = %s"""
+
+
+def scribble_params(s: NewScribble) -> tuple:
+    return (s.user_id, s.username, s.editor, s.style, s.color, s.thin, s.dashed,
+            orjson.dumps({'type': 'LineString', 'coordinates': s.points}).decode())
+
+
+def label_params(s: NewLabel) -> tuple:
+    return (s.user_id, s.username, s.editor, s.color, s.text, *s.location)
+
+
+async def fetch_returned_ids(cur) -> list[int]:
+    """Collects ids from every result set of an executemany with returning=True."""
+    ids = [(await cur.fetchone())['scribble_id']]
+    while cur.nextset():
+        ids.append((await cur.fetchone())['scribble_id'])
+    return ids
 
 
 async def insert_scribble(cur, s: NewScribble) -> int:
-    await cur.execute(
-        """insert into scribbles
-        (user_id, username, editor, style, color, thin, dashed, geom)
-        values (%s, %s, %s, %s, %s, %s, %s, ST_SetSRID(ST_GeomFromGeoJSON(%s), 4326))
-        returning scribble_id""",
-        (s.user_id, s.username, s.editor, s.style, s.color, s.thin, s.dashed,
-         json.dumps({'type': 'LineString', 'coordinates': s.points})))
+    await cur.execute(INSERT_SCRIBBLE_SQL, scribble_params(s))
     return (await cur.fetchone())['scribble_id']
 
 
+async def insert_scribbles(cur, scribbles: list[NewScribble]) -> list[int]:
+    if not scribbles:
+        return []
+    await cur.executemany(
+        INSERT_SCRIBBLE_SQL, [scribble_params(s) for s in scribbles], returning=True)
+    return await fetch_returned_ids(cur)
+
+
 async def insert_label(cur, s: NewLabel) -> int:
-    await cur.execute(
-        """insert into scribbles
-        (user_id, username, editor, color, label, geom)
-        values (%s, %s, %s, %s, %s, ST_Point(%s, %s, 4326))
-        returning scribble_id""",
-        (s.user_id, s.username, s.editor, s.color, s.text, *s.location))
+    await cur.execute(INSERT_LABEL_SQL, label_params(s))
     return (await cur.fetchone())['scribble_id']
 
 
+async def insert_labels(cur, labels: list[NewLabel]) -> list[int]:
+    if not labels:
+        return []
+    await cur.executemany(
+        INSERT_LABEL_SQL, [label_params(s) for s in labels], returning=True)
+    return await fetch_returned_ids(cur)
+
+
 async def delete_scribble(cur, s: Deletion) -> int:
-    await cur.execute(
-        "update scribbles set deleted = now(), deleted_by_id = %s where scribble_id = %s",
-        (s.user_id, s.id))
+    await cur.execute(DELETE_SCRIBBLE_SQL, (s.user_id, s.id))
     return s.id
 
 
+async def delete_scribbles(cur, deletions: list[Deletion]) -> list[int]:
+    if deletions:
+        await cur.executemany(DELETE_SCRIBBLE_SQL, [(s.user_id, s.id) for s in deletions])
+    return [s.id for s in deletions]
+
+
+GEOCODE_ENDPOINT = 'https://nominatim.openstreetmap.org/reverse'
+GEOCODE_PARAMS = {
+    'format': 'jsonv2',
+    'accept-language': 'en',
+    'zoom': '12',
+    'layer': 'address',
+    'email': config.EMAIL,
+}
+# Nominatim allows at most one request per second.
+GEOCODE_INTERVAL = 1.0
+_geocode_session: Optional[aiohttp.ClientSession] = None
+_geocode_lock = asyncio.Lock()
+
+
+async def get_geocode_session() -> aiohttp.ClientSession:
+    global _geocode_session
+    async with _geocode_lock:
+        if _geocode_session is None or _geocode_session.closed:
+            _geocode_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=1, keepalive_timeout=75),
+                headers={'User-Agent': 'geoscribble/1.0'},
+            )
+    return _geocode_session
+
+
+async def close_geocode_session() -> None:
+    global _geocode_session
+    if _geocode_session is not None:
+        await _geocode_session.close()
+        _geocode_session = None
+
+
 async def reverse_geocode(lon: float, lat: float) -> Optional[str]:
-    async with aiohttp.ClientSession() as session:
-        endpoint = 'https://nominatim.openstreetmap.org/reverse'
-        params = {
-            'format': 'jsonv2',
-            'lat': lat,
-            'lon': lon,
-            'accept-language': 'en',
-            'zoom': '12',
-            'layer': 'address',
-            'email': config.EMAIL,
-        }
-        async with session.get(endpoint, params=params) as response:
-            if response.status == 200:
-                data = await response.json()
-                return data.get('display_name')
-            else:
-                logging.warn('Could not geocode %s: %s',
-                             response.url, await response.text())
+    session = await get_geocode_session()
+    params = {**GEOCODE_PARAMS, 'lat': lat, 'lon': lon}
+    async with session.get(GEOCODE_ENDPOINT, params=params) as response:
+        if response.status == 200:
+            data = await response.json()
+            return data.get('display_name')
+        elif logging.getLogger().isEnabledFor(logging.WARNING):
+            logging.warning('Could not geocode %s: %s',
+                            response.url, await response.text())
     return None
 
 
+async def geocode_tasks(tasks: list[tuple[int, float, float]]) -> list[tuple[str, int]]:
+    """Reverse geocodes (task_id, lon, lat) tuples, keeping to the Nominatim rate limit.
+    Returns (location_str, task_id) tuples for successful lookups."""
+    loop = asyncio.get_running_loop()
+    limiter = asyncio.Semaphore(1)
+    next_allowed = 0.0
+
+    async def geocode(task_id: int, lon: float, lat: float) -> Optional[tuple[str, int]]:
+        nonlocal next_allowed
+        async with limiter:
+            now = loop.time()
+            next_allowed = max(now, next_allowed + GEOCODE_INTERVAL)
+            await asyncio.sleep(next_allowed - now)
+            loc = await reverse_geocode(lon, lat)
+        return (loc, task_id) if loc else None
+
+    results = await asyncio.gather(*(geocode(*t) for t in tasks))
+    return [r for r in results if r]
+
+
 async def update_tasks() -> None:
     async with get_cursor(True) as cur:
         # Run the script from the file.
-        filename = os.path.join(os.path.dirname(__file__), 'update_tasks.sql')
-        with open(filename, 'r') as f:
-            sql = f.read()
-        await cur.execute(sql)
+        await cur.execute(read_sql('update_tasks.sql'))
 
         # Get max task_id for reverse geocoding.
         await cur.execute("select max(task_id) t from tasks where location_str is not null")
         last_geocoded = (await cur.fetchone())['t'] or 0
 
-        # Reverse geocode the new tasks.
         await cur.execute(
             "select task_id, ST_X(location) lon, ST_Y(location) lat "
             "from tasks where task_id > %s and task_id <= %s",
             (last_geocoded, last_geocoded + config.MAX_GEOCODE))
-        locs: list[tuple[str, int]] = []
-        async for row in cur:
-            loc = await reverse_geocode(row['lon'], row['lat'])
-            if loc:
-                locs.append((loc, row['task_id']))
-            await asyncio.sleep(1.2)
-        await cur.executemany("update tasks set location_str = %s where task_id = %s", locs)
+        rows = [(row['task_id'], row['lon'], row['lat']) for row in await cur.fetchall()]
+
+    # Reverse geocode the new tasks without holding a database connection.
+    locs = await geocode_tasks(rows)
+    if not locs:
+        return
+
+    async with get_cursor(True) as cur:
+        # One statement for all tasks instead of a round-trip per task.
+        await cur.execute(
+            "update tasks set location_str = v.loc "
+            "from unnest(%s::text[], %s::integer[]) as v(loc, task_id) "
+            "where tasks.task_id = v.task_id",
+            ([loc for loc, _ in locs], [task_id for _, task_id in locs]))
+
+
+# Formatted SQL for list_tasks(), keyed by (bbox, username, user_id, limit).
+_TASKS_SQL: dict[tuple[bool, bool, bool, int], str] = {}
+
+
+def tasks_sql(bbox: bool, username: bool, user_id: bool, limit: int) -> str:
+    key = (bbox, username, user_id, limit)
+    sql = _TASKS_SQL.get(key)
+    if sql is not None:
+        return sql
+
+    add_queries: list[str] = []
+    if bbox:
+        add_queries.append('and ST_Intersects(location, ST_MakeEnvelope(%s, %s, %s, %s, 4326))')
+    if username:
+        add_queries.append('and username = %s')
+    if user_id:
+        add_queries.append('and user_id = %s')
+
+    sql = """select task_id, ST_X(location), ST_Y(location), location_str, scribbles,
+    username, user_id, created, processed, processed_by_id from tasks
+    where created >= %s {q} order by created desc limit {limit}""".format(
+        q=' '.join(add_queries), limit=int(limit))
+    _TASKS_SQL[key] = sql
+    return sql
 
 
 async def list_tasks(bbox: Optional[list[float]] = None,
                      username: Optional[str] = None, user_id: Optional[int] = None,
                      maxage: Optional[int] = None,
                      since: Optional[datetime] = None, limit: int = 100) -> list[Task]:
-    age = maxage or config.DEFAULT_AGE
     if not since:
-        since = datetime.now() - timedelta(days=age)
+        since = datetime.now() - (timedelta(days=maxage) if maxage else DEFAULT_AGE)
 
     params: list = [since]
-    add_queries: list[str] = []
-
     if bbox:
-        add_queries.append('and ST_Intersects(location, ST_MakeEnvelope(%s, %s, %s, %s, 4326))')
         params.extend(bbox)
     if username:
-        add_queries.append('and username = %s')
         params.append(username)
     if user_id:
-        add_queries.append('and user_id = %s')
         params.append(user_id)
-
-    sql = """select *, ST_AsGeoJSON(location) json from tasks
-    where created >= %s {q} order by created desc limit {limit}""".format(
-        q=' '.join(add_queries), limit=limit)
+    sql = tasks_sql(bool(bbox), bool(username), bool(user_id), limit)
 
     result: list[Task] = []
-    async with get_cursor() as cur:
-        await cur.execute(sql, params)
-        async for row in cur:
-            geom = json.loads(row['json'])
+    async with get_cursor(row_factory=tuple_row, binary=True) as cur:
+        await cur.execute(sql, params, prepare=True)
+        async for (task_id, lon, lat, location_str, scribbles,
+                   username, user_id, created, processed, processed_by_id) in cur:
             result.append(Task(
-                id=row['task_id'],
-                location=(geom['coordinates'][0],
-                          geom['coordinates'][1]),
-                location_str=row['location_str'],
-                scribbles=row['scribbles'],
-                username=row['username'],
-                user_id=row['user_id'],
-                created=row['created'],
-                processed=row['processed'],
-                processed_by_id=row['processed_by_id'],
+                id=task_id,
+                location=(lon, lat),
+                location_str=location_str,
+                scribbles=scribbles,
+                username=username,
+                user_id=user_id,
+                created=created,
+                processed=processed,
+                processed_by_id=processed_by_id,
             ))
 
     return result
@@ -1,57 +1,107 @@
+import functools
+import hashlib
+import httpx
 import logging
+import orjson
 import os
-from typing import Annotated, Union, Optional
+import re
+from typing import Annotated, Callable, Union, Optional
 from fastapi import FastAPI, Query, HTTPException, Response, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import (
+    HTMLResponse, RedirectResponse, ORJSONResponse, StreamingResponse,
+)
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
 from authlib.integrations.starlette_client import OAuth
 from authlib.common.errors import AuthlibBaseError
 from xml.etree import ElementTree as etree
+from xml.sax.saxutils import unescape
+from cachetools import TTLCache
+from pydantic import TypeAdapter, ValidationError
 from . import config
 from .models import (
     NewScribble, NewLabel, Deletion, Scribble, Label,
-    FeatureCollection, Feature, Box, Task,
+    FeatureCollection, Box, Task,
 )
 from .db import (
-    init_database, query, get_cursor,
-    insert_scribble, insert_label, delete_scribble,
+    init_database, query, query_raw, get_cursor, clear_overview_cache,
+    insert_scribble, insert_label,
+    insert_scribbles, insert_labels, delete_scribbles,
     list_tasks, mark_processed,
 )
-from .wms import get_map, get_capabilities
+from .wms import get_map, get_capabilities, MAP_FORMATS
 
 
 logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 app.add_middleware(CORSMiddleware, allow_origins=['*'])
 app.add_middleware(SessionMiddleware, secret_key=config.SECRET_KEY, max_age=3600*24*365)
-templates = Jinja2Templates(directory=os.path.join(os.path.dirname(__file__), 'templates'))
+TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+templates = Jinja2Templates(directory=TEMPLATES_DIR)
+
+OSM_API = 'https://api.openstreetmap.org/api/0.6/'
 
 oauth = OAuth()
 oauth.register(
     'openstreetmap',
-    api_base_url='https://api.openstreetmap.org/api/0.6/',
+    api_base_url=OSM_API,
     access_token_url='https://www.openstreetmap.org/oauth2/token',
     authorize_url='https://www.openstreetmap.org/oauth2/authorize',
     client_id=config.OAUTH_ID,
     client_secret=config.OAUTH_SECRET,
-    client_kwargs={'scope': 'read_prefs'},
+    client_kwargs={'scope': 'read_prefs', 'timeout': 10},
 )
 
+# Kept open between logins, so the connection to the OSM API is reused.
+osm_api = httpx.AsyncClient(base_url=OSM_API, timeout=10, http2=True)
+
+
+# The map page is plain HTML without template tags, so it is read once on startup.
+browse_html: bytes = b''
+
 
 @app.on_event('startup')
 async def startup():
+    global browse_html
+    with open(os.path.join(TEMPLATES_DIR, 'browse.html'), 'rb') as f:
+        browse_html = f.read()
     await init_database()
 
 
+@app.on_event('shutdown')
+async def shutdown():
+    await osm_api.aclose()
+
+
+@functools.lru_cache(maxsize=16)
+def make_etag(content: bytes) -> str:
+    return '"' + hashlib.sha1(content).hexdigest()[:16] + '"'
+
+
+def static_response(request: Request, content: bytes, media_type: str) -> Response:
+    """Returns content that rarely changes, or 304 if the client already has it."""
+    etag = make_etag(content)
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=300'}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content, media_type=media_type, headers=headers)
+
+
 @app.get('/map', response_class=HTMLResponse, include_in_schema=False)
 async def root(request: Request):
-    return templates.TemplateResponse(request=request, name='browse.html')
+    return static_response(request, browse_html, 'text/html')
+
+
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
 
 
 def format_date(d) -> str:
-    return d.strftime('%d %b %H:%M')
+    # Same as strftime('%d %b %H:%M') in the C locale, without parsing the format.
+    return f'{d.day:02d} {MONTHS[d.month - 1]} {d.hour:02d}:{d.minute:02d}'
 
 
 templates.env.filters['format_date'] = format_date
@@ -77,6 +127,7 @@ async def process_task(task_id: int, request: Request):
     user_id = request.session.get('user_id')
     if user_id:
         await mark_processed(task_id, user_id)
+        response_cache.clear()
     return RedirectResponse(request.url_for('list_edits'))
 
 
@@ -85,6 +136,7 @@ async def unprocess_task(task_id: int, request: Request):
     user_id = request.session.get('user_id')
     if user_id:
         await mark_processed(task_id, None)
+        response_cache.clear()
     return RedirectResponse(request.url_for('list_edits'))
 
 
@@ -100,6 +152,26 @@ async def login_via_osm(request: Request):
     return await oauth.openstreetmap.authorize_redirect(request, redirect_uri)
 
 
+USER_TAG_RE = re.compile(rb'<user\b([^>]*)>')
+USER_ID_RE = re.compile(rb'\bid="(\d+)"')
+USER_NAME_RE = re.compile(rb'\bdisplay_name="([^"]*)"')
+
+
+def parse_user_details(content: bytes) -> tuple[Optional[str], Optional[str]]:
+    """Returns display_name and id from the OSM API user/details response."""
+    tag = USER_TAG_RE.search(content)
+    if tag:
+        uid = USER_ID_RE.search(tag.group(1))
+        name = USER_NAME_RE.search(tag.group(1))
+        # unescape() knows only named entities, numeric references need the parser.
+        if uid and name and b'&#' not in name.group(1):
+            return (unescape(name.group(1).decode(), {'&quot;': '"', '&apos;': "'"}),
+                    uid.group(1).decode())
+    # Fall back to a proper XML parser.
+    user_details = etree.fromstring(content)
+    return user_details[0].get('display_name'), user_details[0].get('id')
+
+
 @app.get("/auth", include_in_schema=False)
 async def auth_via_osm(request: Request):
     try:
@@ -107,10 +179,11 @@ async def auth_via_osm(request: Request):
     except AuthlibBaseError:
         return HTMLResponse('Denied. <a href="' + request.url_for('list_edits') + '">Go back</a>.')
 
-    response = await oauth.openstreetmap.get('user/details', token=token)
-    user_details = etree.fromstring(response.content)
-    request.session['username'] = user_details[0].get('display_name')
-    request.session['user_id'] = int(user_details[0].get('id') or 1)
+    response = await osm_api.get(
+        'user/details', headers={'Authorization': f'Bearer {token["access_token"]}'})
+    username, user_id = parse_user_details(response.content)
+    request.session['username'] = username
+    request.session['user_id'] = int(user_id or 1)
 
     return RedirectResponse(request.url_for('list_edits'))
 
@@ -122,139 +195,284 @@ async def logout(request: Request):
     return RedirectResponse(request.url_for('list_edits'), 302)
 
 
-@app.get('/tasks')
+# Four comma-separated numbers, without spaces.
+BBOX_PATTERN = r'^-?\d+(?:\.\d+)?(,-?\d+(?:\.\d+)?){3}$'
+
+
+def parse_bbox(bbox: str) -> list[float]:
+    # The pattern has already been checked, so no need to strip.
+    return list(map(float, bbox.split(',')))
+
+
+# Serialized responses of /tasks and /scribbles. Cleared on every write,
+# but other workers may still serve old data until the entries expire.
+# The size is counted in bytes, so a few huge bodies cannot eat the memory.
+response_cache: TTLCache = TTLCache(
+    maxsize=config.RESPONSE_CACHE_SIZE * 1024 * 1024, ttl=30, getsizeof=len)
+
+
+def cache_response(key: tuple, content: bytes) -> None:
+    # TTLCache refuses values bigger than the whole cache.
+    if len(content) <= response_cache.maxsize:
+        response_cache[key] = content
+
+
+TASKS_ADAPTER = TypeAdapter(list[Task])
+SCRIBBLES_ADAPTER = TypeAdapter(list[Union[Scribble, Label, Box]])
+
+
+@app.get('/tasks', response_model=list[Task])
 async def tasks(
-        bbox: Annotated[Optional[str], Query(pattern=r'^-?\d+(?:\.\d+)?(,-?\d+(?:\.\d+)?){3}$')],
+        bbox: Annotated[Optional[str], Query(pattern=BBOX_PATTERN)],
         username: Optional[str] = None, user_id: Optional[int] = None,
-        maxage: Optional[int] = None) -> list[Task]:
+        maxage: Optional[int] = None) -> Response:
     """List tasks (grouped scribbles) by user and date."""
-    box = None if not bbox else [float(part.strip()) for part in bbox.split(',')]
-    return await list_tasks(box, username, user_id, maxage)
+    key = ('tasks', bbox, username, user_id, maxage)
+    content = response_cache.get(key)
+    if content is None:
+        box = None if not bbox else parse_bbox(bbox)
+        content = TASKS_ADAPTER.dump_json(await list_tasks(box, username, user_id, maxage))
+        cache_response(key, content)
+    return Response(content, media_type='application/json')
 
 
-@app.get('/scribbles')
+@app.get('/scribbles', response_model=list[Union[Scribble, Label, Box]])
 async def scribbles(
-        bbox: Annotated[str, Query(pattern=r'^-?\d+(?:\.\d+)?(,-?\d+(?:\.\d+)?){3}$')],
+        bbox: Annotated[str, Query(pattern=BBOX_PATTERN)],
         username: Optional[str] = None, user_id: Optional[int] = None,
-        maxage: Optional[int] = None) -> list[Union[Scribble, Label, Box]]:
+        maxage: Optional[int] = None) -> Response:
     """Return scribbles for a given area, in a raw json format."""
-    box = [float(part.strip()) for part in bbox.split(',')]
-    return await query(box, username, user_id, None, maxage)
+    key = ('scribbles', bbox, username, user_id, maxage)
+    content = response_cache.get(key)
+    if content is None:
+        box = parse_bbox(bbox)
+        content = SCRIBBLES_ADAPTER.dump_json(
+            await query(box, username, user_id, None, maxage))
+        cache_response(key, content)
+    return Response(content, media_type='application/json')
+
+
+def scribble_feature(row: tuple) -> dict:
+    (scribble_id, created, username, user_id, editor,
+     style, color, dashed, thin, _, _, pts) = row
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'LineString', 'coordinates': pts},
+        'properties': {
+            'type': 'scribble',
+            'id': scribble_id,
+            'style': style,
+            'color': None if not color else f'#{color}',
+            'dashed': dashed,
+            'thin': thin,
+            'userName': username,
+            'userId': user_id,
+            'editor': editor or '',
+            'created': created,
+        },
+    }
+
+
+def label_feature(row: tuple) -> dict:
+    (scribble_id, created, username, user_id, editor,
+     _, color, _, _, label, pt, _) = row
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': pt},
+        'properties': {
+            'type': 'label',
+            'id': scribble_id,
+            'color': None if not color else f'#{color}',
+            'text': label,
+            'username': username,
+            'userId': user_id,
+            'editor': editor or '',
+            'created': created,
+        },
+    }
+
+
+def box_feature(row: tuple) -> dict:
+    xmin, ymin, xmax, ymax, minage = row
+    return {
+        'type': 'Feature',
+        'geometry': {
+            'type': 'Polygon',
+            'coordinates': [[
+                [xmin, ymin],
+                [xmax, ymin],
+                [xmax, ymax],
+                [xmin, ymax],
+                [xmin, ymin],
+            ]],
+        },
+        'properties': {
+            'type': 'box',
+            'minAge': minage,
+        },
+    }
+
+
+# GeoJSON feature builders working on raw rows, by the kind from query_raw().
+FEATURE_BUILDERS: dict[str, Callable[[tuple], dict]] = {
+    'scribble': scribble_feature,
+    'label': label_feature,
+    'box': box_feature,
+}
 
 
-@app.get('/geojson')
+# Features serialized per chunk of the /geojson response body.
+GEOJSON_CHUNK = 500
+
+
+@app.get('/geojson', response_model=FeatureCollection)
 async def geojson(
-        bbox: Annotated[str, Query(pattern=r'^-?\d+(?:\.\d+)?(,-?\d+(?:\.\d+)?){3}$')],
-        username: Optional[str] = None, user_id: Optional[str] = None,
-        maxage: Optional[int] = None) -> FeatureCollection:
+        bbox: Annotated[str, Query(pattern=BBOX_PATTERN)],
+        username: Optional[str] = None, user_id: Optional[int] = None,
+        maxage: Optional[int] = None) -> StreamingResponse:
     """Return scribbles for a given area as GeoJSON."""
-    scr = await scribbles(bbox, username, user_id, maxage)
-    features = []
-    for s in scr:
-        if isinstance(s, Scribble):
-            features.append(Feature(
-                f_type='Feature',
-                geometry={'type': 'LineString', 'coordinates': s.points},
-                properties={
-                    'type': 'scribble',
-                    'id': s.id,
-                    'style': s.style,
-                    'color': None if not s.color else f'#{s.color}',
-                    'dashed': s.dashed,
-                    'thin': s.thin,
-                    'userName': s.username,
-                    'userId': s.user_id,
-                    'editor': s.editor,
-                    'created': s.created,
-                }
-            ))
-        elif isinstance(s, Label):
-            features.append(Feature(
-                f_type='Feature',
-                geometry={'type': 'Point', 'coordinates': s.location},
-                properties={
-                    'type': 'label',
-                    'id': s.id,
-                    'color': None if not s.color else f'#{s.color}',
-                    'text': s.text,
-                    'username': s.username,
-                    'userId': s.user_id,
-                    'editor': s.editor,
-                    'created': s.created,
-                }
-            ))
-        elif isinstance(s, Box):
-            features.append(Feature(
-                f_type='Feature',
-                geometry={
-                    'type': 'Polygon',
-                    'coordinates': [[
-                        [s.box[0], s.box[1]],
-                        [s.box[2], s.box[1]],
-                        [s.box[2], s.box[3]],
-                        [s.box[0], s.box[3]],
-                        [s.box[0], s.box[1]],
-                    ]],
-                },
-                properties={
-                    'type': 'box',
-                    'minAge': s.minage,
-                },
-            ))
-    return FeatureCollection(features=features)
+    box = parse_bbox(bbox)
+    # Rows are read in full first: a database error gives a proper error response,
+    # and no pooled connection waits on a slow client.
+    rows = await query_raw(box, username, user_id, None, maxage)
+
+    async def generate():
+        # Features are serialized in chunks, so the whole body is never in memory.
+        yield b'{"type":"FeatureCollection","features":['
+        for start in range(0, len(rows), GEOJSON_CHUNK):
+            chunk = b','.join(
+                orjson.dumps(FEATURE_BUILDERS[kind](row))
+                for kind, row in rows[start:start + GEOJSON_CHUNK])
+            yield chunk if start == 0 else b',' + chunk
+        yield b']}'
+
+    return StreamingResponse(generate(), media_type='application/json')
+
+
+# Lowercase names of query parameters that WMS requests use.
+WMS_PARAMS = frozenset((
+    'request', 'service', 'format', 'bbox', 'width', 'height', 'layers',
+    'crs', 'srs', 'user_id', 'username',
+))
+
+# Parameters that GetMap cannot work without. CRS is checked in get_map, since it can be SRS.
+GETMAP_PARAMS = frozenset(('format', 'bbox', 'width', 'height', 'layers'))
+
+
+def wms_params(request: Request) -> dict[str, str]:
+    """Picks known WMS parameters from the query, ignoring the case of names."""
+    params = {}
+    for k, v in request.query_params.items():
+        if k in WMS_PARAMS:
+            params[k] = v
+        else:
+            lk = k.lower()
+            if lk in WMS_PARAMS:
+                params[lk] = v
+    return params
 
 
 @app.get('/wms')
 async def wms(request: Request):
     """WMS endpoint for editors."""
-    params = {k.lower(): v for k, v in request.query_params.items()}
+    params = wms_params(request)
     if params.get('request') == 'GetCapabilities':
         if params.get('service', 'WMS').lower() != 'wms':
             raise HTTPException(422, "Please use WMS for service")
         base_url = config.BASE_URL or request.scope.get('root_path') or request.base_url
-        xml = get_capabilities(base_url)  # TODO: url behind proxy
-        return Response(content=xml, media_type='application/xml')
+        xml = get_capabilities(str(base_url))  # TODO: url behind proxy
+        return static_response(request, xml, 'application/vnd.ogc.wms_xml')
     elif params.get('request') == 'GetMap':
-        if any([k not in params for k in ('format', 'bbox', 'width', 'height', 'layers')]):
+        if not GETMAP_PARAMS.issubset(params):
             raise HTTPException(422, "Missing parameter for GetMap")
-        if params.get('format') != 'image/png':
-            raise HTTPException(422, "GetMap supports only PNG images")
+        if params['format'] not in MAP_FORMATS:
+            raise HTTPException(422, "GetMap supports only PNG and WebP images")
         data = await get_map(params)
-        return Response(content=data, media_type='image/png')
+        return Response(content=data, media_type=params['format'])
     else:
         raise HTTPException(422, "This server supports only GetCapabilities and GetMap")
 
 
-@app.post('/upload')
-async def put_scribbles(
-        scribbles: list[Union[NewScribble, NewLabel, Deletion]]
-        ) -> list[Optional[int]]:
+UPLOAD_ADAPTER = TypeAdapter(list[Union[NewScribble, NewLabel, Deletion]])
+# Bigger uploads are validated in a thread to keep the event loop responsive.
+UPLOAD_THREAD_SIZE = 1024 * 1024
+# The body is parsed by hand, so its schema is documented explicitly. Definitions
+# are referenced by a JSON pointer into the same schema, to keep it self-contained.
+UPLOAD_SCHEMA = UPLOAD_ADAPTER.json_schema(ref_template=(
+    '#/paths/~1upload/post/requestBody/content/application~1json/schema/$defs/{model}'))
+
+
+@app.post('/upload', openapi_extra={'requestBody': {
+    'required': True,
+    'content': {'application/json': {'schema': UPLOAD_SCHEMA}},
+}})
+async def put_scribbles(request: Request) -> list[Optional[int]]:
     """Batch upload scribbles, labels, and deletions."""
+    body = await request.body()
+    try:
+        if len(body) > UPLOAD_THREAD_SIZE:
+            scribbles = await run_in_threadpool(UPLOAD_ADAPTER.validate_json, body)
+        else:
+            scribbles = UPLOAD_ADAPTER.validate_json(body)
+    except ValidationError as e:
+        # Locations start with 'body', like when FastAPI validates the body itself.
+        raise RequestValidationError([
+            {**err, 'loc': ('body', *err['loc'])}
+            for err in e.errors(include_url=False)
+        ])
+
     # Check that at least the user is the same
-    for i in range(1, len(scribbles)):
-        if (scribbles[i].user_id != scribbles[0].user_id or
-                scribbles[i].username != scribbles[0].username or
-                scribbles[i].editor != scribbles[0].editor):
+    if scribbles:
+        first = (scribbles[0].user_id, scribbles[0].username, scribbles[0].editor)
+        if any((s.user_id, s.username, s.editor) != first for s in scribbles[1:]):
             raise HTTPException(401, "User and editor should be the same for all elements")
 
-    new_ids: list[Optional[int]] = []
+    # Group elements by type, remembering their positions, to run one batch per type.
+    new_scribbles: list[NewScribble] = []
+    new_labels: list[NewLabel] = []
+    deletions: list[Deletion] = []
+    scribble_pos: list[int] = []
+    label_pos: list[int] = []
+    deletion_pos: list[int] = []
+    for i, s in enumerate(scribbles):
+        if isinstance(s, NewScribble):
+            new_scribbles.append(s)
+            scribble_pos.append(i)
+        elif isinstance(s, NewLabel):
+            new_labels.append(s)
+            label_pos.append(i)
+        elif isinstance(s, Deletion):
+            deletions.append(s)
+            deletion_pos.append(i)
+
     async with get_cursor(True) as cur:
-        for s in scribbles:
-            if isinstance(s, NewScribble):
-                new_ids.append(await insert_scribble(cur, s))
-            elif isinstance(s, NewLabel):
-                new_ids.append(await insert_label(cur, s))
-            elif isinstance(s, Deletion):
-                new_ids.append(await delete_scribble(cur, s))
+        batches = [
+            (scribble_pos, await insert_scribbles(cur, new_scribbles)),
+            (label_pos, await insert_labels(cur, new_labels)),
+            (deletion_pos, await delete_scribbles(cur, deletions)),
+        ]
+
+    response_cache.clear()
+    clear_overview_cache()
+
+    new_ids: list[Optional[int]] = [None] * len(scribbles)
+    for positions, ids in batches:
+        for i, new_id in zip(positions, ids):
+            new_ids[i] = new_id
     return new_ids
 
 
 @app.put('/new')
 async def put_one_scribble(scribble: Union[NewScribble, NewLabel]) -> int:
     """Upload one scribble or label."""
+    new_id: Optional[int] = None
     async with get_cursor(True) as cur:
         if isinstance(scribble, NewScribble):
-            return await insert_scribble(cur, scribble)
+            new_id = await insert_scribble(cur, scribble)
         elif isinstance(scribble, NewLabel):
-            return await insert_label(cur, scribble)
-    raise HTTPException(401)  # TODO: proper error
+            new_id = await insert_label(cur, scribble)
+    if new_id is None:
+        raise HTTPException(401)  # TODO: proper error
+    response_cache.clear()
+    clear_overview_cache()
+    return new_id
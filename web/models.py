@@ -1,4 +1,4 @@
-from math import radians, cos, sqrt
+from math import radians, cos, hypot
 from typing import Annotated, Optional
 from annotated_types import Len
 from pydantic import BaseModel, Field, PastDatetime
@@ -14,22 +14,27 @@ class Identification(BaseModel):
         description='Editor that uploaded the element', examples=['Every Door'])]
 
 
+EARTH_RADIUS = 6371000
+
+
 def distance(p1: tuple[float, float], p2: tuple[float, float]) -> float:
-    l1 = radians(p1[1])
-    l2 = radians(p2[1])
-    f1 = radians(p1[0])
-    f2 = radians(p2[0])
+    """Equirectangular distance in meters between two (lon, lat) points."""
+    f1 = radians(p1[1])
+    f2 = radians(p2[1])
+    l1 = radians(p1[0])
+    l2 = radians(p2[0])
     x = (l2 - l1) * cos((f1 + f2) / 2)
     y = f2 - f1
-    return sqrt(x * x + y * y) * 6371000
+    return hypot(x, y) * EARTH_RADIUS
 
 
 def validate_length(points: list[tuple[float, float]]):
     length = 0.0
     for i in range(1, len(points)):
         length += distance(points[i-1], points[i])
-    assert length <= config.MAX_LENGTH, (
-        f'Length of a scribble should be under {config.MAX_LENGTH} meters')
+        # Stop as soon as the limit is crossed, no need to measure the rest.
+        assert length <= config.MAX_LENGTH, (
+            f'Length of a scribble should be under {config.MAX_LENGTH} meters')
     return points
 
 
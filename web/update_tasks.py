@@ -1,11 +1,14 @@
 import asyncio
 import logging
-from .db import init_database, update_tasks
+from .db import init_database, update_tasks, close_geocode_session
 
 
 async def update():
     await init_database()
-    await update_tasks()
+    try:
+        await update_tasks()
+    finally:
+        await close_geocode_session()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,5 @@
+-- Precomputed geohash for overview queries, prefix it for a lower precision.
+alter table scribbles add column if not exists
+    geohash10 text generated always as (ST_GeoHash(geom, 10)) stored;
+
+create index if not exists scribbles_idx_geohash10 on scribbles (geohash10);
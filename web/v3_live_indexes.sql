@@ -0,0 +1,5 @@
+-- Partial indexes that skip deleted scribbles.
+create index if not exists scribbles_idx_geom_live on scribbles
+    using gist (geom) where deleted is null;
+create index if not exists scribbles_idx_created_live on scribbles
+    (created desc) where deleted is null;
@@ -1,3 +1,7 @@
+import asyncio
+import functools
+from bisect import bisect_left
+import numpy as np
 from fastapi import HTTPException
 from io import BytesIO
 from . import config
@@ -6,11 +10,15 @@ from .models import Scribble, Label, Box
 from .db import query
 from .dashed_draw import DashedImageDraw
 from PIL import Image, ImageDraw, ImageFont
-from typing import Union
+from typing import Callable, Optional, Union
 
 
-def get_capabilities(endpoint: str) -> str:
-    srs = '\n'.join([f'<SRS>{k}</SRS>' for k in CRS_LIST.keys()])
+# CRS_LIST is fixed, so its part of the capabilities document is too.
+SRS_XML = '\n'.join(f'<SRS>{k}</SRS>' for k in CRS_LIST)
+
+
+@functools.lru_cache(maxsize=8)
+def get_capabilities(endpoint: str) -> bytes:
     xml = """<?xml version='1.0' encoding="UTF-8" standalone="no" ?>
 <WMS_Capabilities xmlns="http://www.opengis.net/wms" version="1.1.1">
 <Service>
@@ -33,6 +41,7 @@ def get_capabilities(endpoint: str) -> str:
     </GetCapabilities>
     <GetMap>
       <Format>image/png</Format>
+      <Format>image/webp</Format>
       <DCPType>
         <HTTP>
           <Get><OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink"
@@ -67,8 +76,12 @@ def get_capabilities(endpoint: str) -> str:
   </Layer>
 </Capability>
 </WMS_Capabilities>
-    """.format(url=str(endpoint).rstrip('/'), srs=srs)
-    return xml
+    """.format(url=endpoint.rstrip('/'), srs=SRS_XML)
+    return xml.encode('utf-8')
+
+
+# Image formats GetMap can produce.
+MAP_FORMATS = frozenset(('image/png', 'image/webp'))
 
 
 async def get_map(params: dict[str, str]) -> bytes:
@@ -108,64 +121,129 @@ async def get_map(params: dict[str, str]) -> bytes:
         bbox_obj.to_4326(), maxage=maxage,
         user_id=user_id, username=params.get('username'),
     )
+    if not scribbles:
+        return empty_image(width, height, params.get('format'))
+
+    # Drawing and encoding are CPU-bound, so keep them off the event loop.
+    return await asyncio.to_thread(
+        render_and_encode, width, height, bbox_obj, scribbles, params.get('format'))
+
+
+@functools.lru_cache(maxsize=16)
+def empty_image(width: int, height: int, fmt: Optional[str]) -> bytes:
+    """Transparent image for areas without scribbles, encoded once per size."""
+    content = BytesIO()
+    image = Image.new('RGBA', (width, height))
+    if fmt == 'image/webp':
+        image.save(content, 'WEBP', lossless=True)
+    else:
+        image.save(content, 'PNG', compress_level=9)
+    return content.getvalue()
+
+
+def render_and_encode(width: int, height: int, bbox: BBox,
+                      scribbles: list[Union[Scribble, Label, Box]],
+                      fmt: Optional[str]) -> bytes:
     out = Image.new('RGBA', (width, height))
-    render_image(out, bbox_obj, scribbles)
+    render_image(out, bbox, scribbles)
     content = BytesIO()
-    out.save(content, 'PNG')
+    if fmt == 'image/webp':
+        out.save(content, 'WEBP', quality=85, method=0)
+    else:
+        # Maps are viewed once, so fast compression matters more than size.
+        out.save(content, 'PNG', compress_level=1)
     return content.getvalue()
 
 
-def render_image(image: Image, bbox: BBox, scribbles: list[Union[Scribble, Label]]):
-    age_colors = {
-        3: '#ffffb2',
-        7: '#fed976',
-        14: '#feb24c',
-        30: '#fd8d3c',
-        61: '#f03b20',
-        1000: '#bd0026',
-    }
+# Box colors for ages up to each threshold in days; older boxes get the last one.
+AGE_THRESHOLDS = (3, 7, 14, 30, 61, 1000)
+AGE_COLORS = ('#ffffb2', '#fed976', '#feb24c', '#fd8d3c', '#f03b20', '#bd0026')
+
+
+@functools.lru_cache(maxsize=4)
+def get_font(size: int = 14) -> Union[ImageFont.FreeTypeFont, ImageFont.ImageFont]:
+    try:
+        return ImageFont.truetype(config.FONT, size=size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+@functools.lru_cache(maxsize=256)
+def hex_to_rgba(color: Optional[str]) -> tuple[int, int, int, int]:
+    """Converts RRGGBB to a tuple for PIL, black when there is no color."""
+    if not color:
+        return (0, 0, 0, 255)
+    v = int(color, 16)
+    return (v >> 16) & 0xFF, (v >> 8) & 0xFF, v & 0xFF, 255
+
+
+def draw_scribble(draw: DashedImageDraw, image: Image.Image, bbox: BBox, s: Scribble) -> None:
+    px = bbox.to_pixel_batch(np.asarray(s.points, dtype=np.float64))
+    px *= (image.width, image.height)
+    coords = list(map(tuple, np.rint(px).astype(np.int32).tolist()))
+    width = 3 if s.thin else 5
+    fill = hex_to_rgba(s.color)
+    if np.ptp(px, axis=0).max() < 1:
+        # The whole line fits inside a pixel: draw a dot as wide as the line.
+        x, y = coords[0]
+        r = width / 2
+        draw.ellipse([(x - r, y - r), (x + r, y + r)], fill=fill)
+    elif s.dashed:
+        draw.dashed_line(coords, (10, 10), fill=fill, width=width)
+    else:
+        draw.line(coords, fill=fill, width=width)
+
+
+def draw_box(draw: DashedImageDraw, image: Image.Image, bbox: BBox, s: Box) -> None:
+    x1, y1 = bbox.to_pixel((s.box[0], s.box[1]))
+    x2, y2 = bbox.to_pixel((s.box[2], s.box[3]))
+    xy = [
+        min(x1, x2) * image.width, min(y1, y2) * image.height,
+        max(x1, x2) * image.width, max(y1, y2) * image.height,
+    ]
+    idx = bisect_left(AGE_THRESHOLDS, s.minage)
+    color = AGE_COLORS[min(idx, len(AGE_COLORS) - 1)]
+    draw.rectangle(xy, fill=color, width=0)
+
+
+def draw_label(draw: DashedImageDraw, image: Image.Image, bbox: BBox, s: Label) -> None:
+    coord = bbox.to_pixel(s.location)
+    coord = (round(coord[0] * image.width), round(coord[1] * image.height))
+    r = 3
+    elcoord = [
+        (coord[0] - r, coord[1] - r),
+        (coord[0] + r, coord[1] + r),
+    ]
+    draw.ellipse(elcoord, outline='#000000', fill='#e0ffe0', width=1)
+    font = get_font(14)
+    # Draw semi-transparent background
+    expand = 3
+    torig = [coord[0] + expand, coord[1] - expand]
+    tbox = font.getbbox(s.text)
+    tbounds = [
+        tbox[0] + torig[0] - expand, -tbox[3] + torig[1] - expand,
+        tbox[2] + torig[0] + expand, tbox[1] + torig[1] + expand,
+    ]
+    draw.rounded_rectangle(tbounds, 5, fill='#00000050')
+    draw.text(torig, s.text, fill='#ffffff', font=font, anchor='lb')
+
+
+# Geometry drawing functions by the exact type returned from query().
+DRAW_HANDLERS: dict[type, Callable] = {
+    Scribble: draw_scribble,
+    Box: draw_box,
+}
+
+
+def render_image(image: Image, bbox: BBox, scribbles: list[Union[Scribble, Label, Box]]):
     draw = DashedImageDraw(image)
+    labels: list[Label] = []
     for s in scribbles:
-        if isinstance(s, Scribble):
-            coords = [bbox.to_pixel(c) for c in s.points]
-            coords = [(round(c[0] * image.width), round(c[1] * image.height)) for c in coords]
-            width = 3 if s.thin else 5
-            if s.dashed:
-                draw.dashed_line(coords, (10, 10), fill=f'#{s.color}', width=width)
-            else:
-                draw.line(coords, fill=f'#{s.color}', width=width)
-        elif isinstance(s, Box):
-            x1, y1 = bbox.to_pixel((s.box[0], s.box[1]))
-            x2, y2 = bbox.to_pixel((s.box[2], s.box[3]))
-            xy = [min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)]
-            color = '#ffffff'  # not used
-            for k in sorted(age_colors.keys()):
-                if s.minage <= k or k == 1000:
-                    color = age_colors[k]
-                    break
-            draw.rectangle(xy, fill=color, width=0)
-    for s in scribbles:
-        # Drawing labels always after geometries
-        if isinstance(s, Label):
-            coord = bbox.to_pixel(s.location)
-            coord = (round(coord[0] * image.width), round(coord[1] * image.height))
-            r = 3
-            elcoord = [
-                (coord[0] - r, coord[1] - r),
-                (coord[0] + r, coord[1] + r),
-            ]
-            draw.ellipse(elcoord, outline='#000000', fill='#e0ffe0', width=1)
-            try:
-                font = ImageFont.truetype(config.FONT, size=14)
-            except OSError:
-                font = ImageFont.load_default()
-            # Draw semi-transparent background
-            expand = 3
-            torig = [coord[0] + expand, coord[1] - expand]
-            tbox = font.getbbox(s.text)
-            tbounds = [
-                tbox[0] + torig[0] - expand, -tbox[3] + torig[1] - expand,
-                tbox[2] + torig[0] + expand, tbox[1] + torig[1] + expand,
-            ]
-            draw.rounded_rectangle(tbounds, 5, fill='#00000050')
-            draw.text(torig, s.text, fill='#ffffff', font=font, anchor='lb')
+        if type(s) is Label:
+            labels.append(s)
+        else:
+            DRAW_HANDLERS[type(s)](draw, image, bbox, s)
+
+    # Drawing labels always after geometries
+    for label in labels:
+        draw_label(draw, image, bbox, label)